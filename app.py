@@ -1,19 +1,68 @@
-﻿import json
+﻿import functools
+import json
+import logging
 import os
 import shutil
+import time
 from datetime import datetime
 
 import streamlit as st
 from dotenv import load_dotenv
 
+try:
+    # Optional: ~5x faster JSON parse/serialize than stdlib
+    import orjson
+except ImportError:
+    orjson = None
+
 from body_type_assessment import DoshaAssessment, get_dosha_color, get_dosha_icon
-from model import handle_query
+from model import handle_query, is_generation_error, warm_up
+
+# Create the storage directories once at import instead of stat'ing them on
+# every history/profile access.
+os.makedirs("chat_histories", exist_ok=True)
+os.makedirs("user_profiles", exist_ok=True)
+
+
+logger = logging.getLogger(__name__)
 
 
 # ------------------------- Helper Functions -------------------------
 
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps_line(obj):
+    """Serialize an object to compact newline-terminated JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(obj, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+# Exact-type lookup table so hot scalar types skip the isinstance chain below.
+_SCALAR_TYPES = frozenset({str, int, float, bool, type(None)})
+
+
 def convert_to_serializable(obj):
     """Convert non-serializable objects to serializable format"""
+    obj_type = type(obj)
+    if obj_type in _SCALAR_TYPES:
+        return obj
+    # The common {"result": "..."} response shape: exact-type checks dodge both
+    # the dumps probe and the recursive rebuild below.
+    if obj_type is dict and all(type(value) in _SCALAR_TYPES for value in obj.values()):
+        return obj
+    if obj_type is list and all(type(item) in _SCALAR_TYPES for item in obj):
+        return obj
+    try:
+        # Fast path: payloads that already serialize cleanly skip the recursive walk.
+        json_dumps_line(obj)
+        return obj
+    except TypeError:
+        pass
     if hasattr(obj, "__dict__"):
         return {key: convert_to_serializable(value) for key, value in obj.__dict__.items()}
     if hasattr(obj, "to_dict"):
@@ -27,6 +76,37 @@ def convert_to_serializable(obj):
     return str(obj)
 
 
+class TransientQueryError(Exception):
+    """Raised inside the cached wrapper so error responses are never memoized."""
+
+    def __init__(self, response):
+        super().__init__(response.get("result", ""))
+        self.response = response
+
+
+def _is_transient_response(response):
+    """Detect error-shaped responses that must not be cached for an hour."""
+    if not isinstance(response, dict) or "body_type" not in response:
+        # Token-missing/auth/except-path responses carry only a result string.
+        return True
+    return is_generation_error(response.get("result", ""))
+
+
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def cached_handle_query(question, body_type=None, _on_token=None):
+    """Memoize handle_query so repeat questions skip the RAG/LLM pipeline.
+
+    st.cache_data does not cache raised exceptions, so error responses are
+    smuggled out through TransientQueryError and stay retryable. The
+    underscore keeps the streaming callback out of the cache key; cache hits
+    simply return the full answer without streaming.
+    """
+    response = handle_query(question, body_type=body_type, on_token=_on_token)
+    if _is_transient_response(response):
+        raise TransientQueryError(response)
+    return response
+
+
 def get_user_id_from_url():
     query_params = st.query_params
     user_id = query_params.get("userId")
@@ -37,131 +117,245 @@ def get_user_id_from_url():
 
 def get_chat_history_file(user_id):
     """Return a unique filename per user"""
-    if not os.path.exists("chat_histories"):
-        os.makedirs("chat_histories")
+    return f"chat_histories/chat_history_{user_id}.jsonl"
+
+
+def get_legacy_chat_history_file(user_id):
+    """Return the pre-JSONL filename kept for migrating old histories."""
     return f"chat_histories/chat_history_{user_id}.json"
 
 
 def load_chat_history(user_id):
     file_path = get_chat_history_file(user_id)
-    if os.path.exists(file_path):
-        try:
-            if os.path.getsize(file_path) == 0:
+    try:
+        chat_history = []
+        # Stream raw byte lines straight into the parser; no intermediate
+        # decode/strip copy of the whole file.
+        with open(file_path, "rb") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    chat_history.append(json_loads(line))
+                except (json.JSONDecodeError, ValueError) as exc:
+                    # A torn line from an interrupted append; skip it and keep the rest.
+                    logger.warning("Skipping corrupted chat history line: %s", exc)
+        return chat_history
+    except FileNotFoundError:
+        legacy_history = load_legacy_chat_history(user_id)
+        if legacy_history:
+            # Persist the migrated entries right away; otherwise the first new
+            # append creates the .jsonl and shadows the legacy file on the
+            # next load, losing the old history.
+            save_chat_history(legacy_history, user_id)
+        return legacy_history
+    except Exception as exc:
+        logger.error("Error loading chat history: %s", exc)
+        return []
+
+
+def load_legacy_chat_history(user_id):
+    """Read an old full-array JSON history so existing users keep their chats."""
+    file_path = get_legacy_chat_history_file(user_id)
+    try:
+        with open(file_path, "rb") as file:
+            content = file.read()
+            if not content.strip():
                 return []
+            return json_loads(content)
+    except FileNotFoundError:
+        return []
+    except (json.JSONDecodeError, ValueError) as exc:
+        logger.warning("Chat history file is corrupted; starting fresh: %s", exc)
+        backup_path = f"{file_path}.backup"
+        try:
+            os.rename(file_path, backup_path)
+            logger.warning("Corrupted file backed up as: %s", backup_path)
+        except Exception:
+            pass
+        return []
+    except Exception as exc:
+        logger.error("Error loading chat history: %s", exc)
+        return []
+
+
+# Coalesce rapid-fire submissions into one append: flush the pending buffer
+# once it reaches this many entries or this much time has passed. The age
+# threshold bounds the durability window — an entry sits unflushed for at
+# most this long past the next interaction.
+PENDING_FLUSH_MAX_ENTRIES = 8
+PENDING_FLUSH_MAX_AGE_SECONDS = 2.0
+
+
+def get_pending_saves_key(user_id):
+    """Per-user buffer key; a mid-session userId change must not leak entries."""
+    return f"_pending_saves_{user_id}"
+
+
+def get_last_flush_key(user_id):
+    return f"_last_flush_ts_{user_id}"
+
+
+def flush_pending_entries(user_id):
+    """Write buffered chat entries to the per-user JSONL log in one append.
+
+    Writes O(1) bytes per turn instead of rewriting the whole history file.
+    """
+    pending = st.session_state.get(get_pending_saves_key(user_id))
+    if not pending:
+        return
+    file_path = get_chat_history_file(user_id)
+    try:
+        with open(file_path, "ab", buffering=8192) as file:
+            for chat_entry in pending:
+                file.write(json_dumps_line(convert_to_serializable(chat_entry)))
+        pending.clear()
+        st.session_state[get_last_flush_key(user_id)] = time.time()
+    except Exception as exc:
+        logger.error("Error saving chat history: %s", exc)
+
+
+def queue_chat_entry(chat_entry, user_id):
+    """Buffer a chat entry, flushing when the count or age threshold is hit."""
+    pending = st.session_state.setdefault(get_pending_saves_key(user_id), [])
+    pending.append(chat_entry)
+    last_flush = st.session_state.get(get_last_flush_key(user_id), 0.0)
+    if len(pending) >= PENDING_FLUSH_MAX_ENTRIES or time.time() - last_flush >= PENDING_FLUSH_MAX_AGE_SECONDS:
+        flush_pending_entries(user_id)
+
+
+# Cap on the active history; older entries move to the archive log so per-save
+# and sidebar-render cost stay bounded as a user's history grows.
+MAX_CHAT_HISTORY_ENTRIES = 200
+
+# How many history entries the sidebar renders eagerly; the rest render only
+# after the "Show older chats" toggle so rerun cost stays O(page size).
+SIDEBAR_RECENT_CHATS = 20
+
 
-            with open(file_path, "r", encoding="utf-8") as file:
-                content = file.read().strip()
-                if not content:
-                    return []
-                return json.loads(content)
-        except (json.JSONDecodeError, ValueError) as exc:
-            print(f"Warning: Chat history file is corrupted. Starting fresh. Error: {exc}")
-            backup_path = f"{file_path}.backup"
-            try:
-                os.rename(file_path, backup_path)
-                print(f"Corrupted file backed up as: {backup_path}")
-            except Exception:
-                pass
-            return []
-        except Exception as exc:
-            print(f"Error loading chat history: {exc}")
-            return []
-    return []
+def get_chat_archive_file(user_id):
+    """Return the archive filename for entries evicted from the active log."""
+    return f"chat_histories/chat_history_{user_id}.archive.jsonl"
+
+
+def trim_chat_history(chat_history, user_id):
+    """Evict the oldest entries past the cap into the per-user archive log."""
+    if len(chat_history) <= MAX_CHAT_HISTORY_ENTRIES:
+        return
+    archived = chat_history[:-MAX_CHAT_HISTORY_ENTRIES]
+    del chat_history[:-MAX_CHAT_HISTORY_ENTRIES]
+    try:
+        with open(get_chat_archive_file(user_id), "ab", buffering=8192) as file:
+            for chat_entry in archived:
+                file.write(json_dumps_line(convert_to_serializable(chat_entry)))
+    except Exception as exc:
+        logger.error("Error archiving chat history: %s", exc)
+
+    # The compaction below persists the in-memory tail wholesale, which covers
+    # anything still sitting in the pending buffer.
+    pending = st.session_state.get(get_pending_saves_key(user_id))
+    if pending:
+        pending.clear()
+        st.session_state[get_last_flush_key(user_id)] = time.time()
+    save_chat_history(chat_history, user_id)
 
 
 def save_chat_history(chat_history, user_id):
+    """Rewrite the full JSONL log atomically (compaction path only)."""
     file_path = get_chat_history_file(user_id)
     try:
-        serializable_history = []
-        for chat in chat_history:
-            serializable_chat = {}
-            for key, value in chat.items():
-                serializable_chat[key] = convert_to_serializable(value)
-            serializable_history.append(serializable_chat)
+        # convert_to_serializable recurses into dicts/lists itself; no outer loop needed.
+        serializable_history = convert_to_serializable(chat_history)
 
         temp_file_path = f"{file_path}.tmp"
-        with open(temp_file_path, "w", encoding="utf-8") as file:
-            json.dump(serializable_history, file, indent=2)
+        with open(temp_file_path, "wb") as file:
+            for serializable_chat in serializable_history:
+                file.write(json_dumps_line(serializable_chat))
 
         shutil.move(temp_file_path, file_path)
 
     except Exception as exc:
-        print(f"Error saving chat history: {exc}")
-        temp_file_path = f"{file_path}.tmp"
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+        logger.error("Error saving chat history: %s", exc)
+        try:
+            os.remove(f"{file_path}.tmp")
+        except FileNotFoundError:
+            pass
 
 
 def clear_chat_history(user_id):
-    file_path = get_chat_history_file(user_id)
-    if os.path.exists(file_path):
-        os.remove(file_path)
+    for file_path in (
+        get_chat_history_file(user_id),
+        get_chat_archive_file(user_id),
+        get_legacy_chat_history_file(user_id),
+    ):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
 
 
 def get_user_profile_file(user_id):
     """Return a unique profile filename per user."""
-    if not os.path.exists("user_profiles"):
-        os.makedirs("user_profiles")
     return f"user_profiles/user_profile_{user_id}.json"
 
 
 def load_user_profile(user_id):
     file_path = get_user_profile_file(user_id)
-    if os.path.exists(file_path):
-        try:
-            if os.path.getsize(file_path) == 0:
+    try:
+        with open(file_path, "rb") as file:
+            content = file.read()
+            if not content.strip():
                 return {}
-
-            with open(file_path, "r", encoding="utf-8") as file:
-                content = file.read().strip()
-                if not content:
-                    return {}
-                return json.loads(content)
-        except (json.JSONDecodeError, ValueError) as exc:
-            print(f"Warning: User profile file is corrupted. Starting fresh. Error: {exc}")
-            backup_path = f"{file_path}.backup"
-            try:
-                os.rename(file_path, backup_path)
-                print(f"Corrupted profile backed up as: {backup_path}")
-            except Exception:
-                pass
-            return {}
-        except Exception as exc:
-            print(f"Error loading user profile: {exc}")
-            return {}
-    return {}
+            return json_loads(content)
+    except FileNotFoundError:
+        return {}
+    except (json.JSONDecodeError, ValueError) as exc:
+        logger.warning("User profile file is corrupted; starting fresh: %s", exc)
+        backup_path = f"{file_path}.backup"
+        try:
+            os.rename(file_path, backup_path)
+            logger.warning("Corrupted profile backed up as: %s", backup_path)
+        except Exception:
+            pass
+        return {}
+    except Exception as exc:
+        logger.error("Error loading user profile: %s", exc)
+        return {}
 
 
 def save_user_profile(profile_data, user_id):
     file_path = get_user_profile_file(user_id)
     try:
         temp_file_path = f"{file_path}.tmp"
-        with open(temp_file_path, "w", encoding="utf-8") as file:
-            json.dump(convert_to_serializable(profile_data), file, indent=2)
+        with open(temp_file_path, "wb") as file:
+            file.write(json_dumps_line(convert_to_serializable(profile_data)))
 
         shutil.move(temp_file_path, file_path)
     except Exception as exc:
-        print(f"Error saving user profile: {exc}")
-        temp_file_path = f"{file_path}.tmp"
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+        logger.error("Error saving user profile: %s", exc)
+        try:
+            os.remove(f"{file_path}.tmp")
+        except FileNotFoundError:
+            pass
 
 
 def clear_user_profile(user_id):
-    file_path = get_user_profile_file(user_id)
-    if os.path.exists(file_path):
-        os.remove(file_path)
+    try:
+        os.remove(get_user_profile_file(user_id))
+    except FileNotFoundError:
+        pass
 
 
-def format_bot_response(response_data, body_type=None):
-    result = response_data.get("result", "")
-    response_body_type = body_type or response_data.get("body_type")
-    body_type_note = ""
-    if response_body_type:
-        body_type_note = f"<p style='font-weight:bold; color:#22543D;'>Your body type: {response_body_type}</p>"
+# Static chat bubble markup, built once at import rather than re-parsed as
+# f-string templates on every call.
+_DISCLAIMER = (
+    "<hr><p style='text-align:center; font-weight:bold;'>"
+    "These remedies are complementary. Consult a healthcare provider for persistent issues.</p>"
+)
 
-    disclaimer = "<hr><p style='text-align:center; font-weight:bold;'>These remedies are complementary. Consult a healthcare provider for persistent issues.</p>"
-    return f"""
+_BODY_TYPE_NOTE_TEMPLATE = "<p style='font-weight:bold; color:#22543D;'>Your body type: {body_type}</p>"
+
+_BOT_RESPONSE_TEMPLATE = """
     <div style="background-color:#F0FCED; padding:10px; border-radius:10px; margin:5px 0;">
         <b>VedaBot:</b>
         {body_type_note}
@@ -170,9 +364,7 @@ def format_bot_response(response_data, body_type=None):
     </div>
     """
 
-
-def format_user_query(query):
-    return f"""
+_USER_QUERY_TEMPLATE = """
     <div style="background-color:#CFEBCF; padding:10px; border-radius:10px; margin:5px 0; text-align:right;">
         <b>You:</b>
         <p>{query}</p>
@@ -180,17 +372,42 @@ def format_user_query(query):
     """
 
 
+def format_bot_response(response_data, body_type=None):
+    result = response_data.get("result", "")
+    response_body_type = body_type or response_data.get("body_type")
+    return _render_bot_response(result, response_body_type)
+
+
+@functools.lru_cache(maxsize=512)
+def _render_bot_response(result, response_body_type):
+    """Build the bot bubble HTML; cached so reruns and history re-selects reuse it."""
+    body_type_note = ""
+    if response_body_type:
+        body_type_note = _BODY_TYPE_NOTE_TEMPLATE.format(body_type=response_body_type)
+    return _BOT_RESPONSE_TEMPLATE.format(body_type_note=body_type_note, result=result, disclaimer=_DISCLAIMER)
+
+
+@functools.lru_cache(maxsize=512)
+def format_user_query(query):
+    return _USER_QUERY_TEMPLATE.format(query=query)
+
+
 def load_css(file_name):
-    if os.path.exists(file_name):
-        with open(file_name, encoding="utf-8") as file:
-            st.markdown(f"<style>{file.read()}</style>", unsafe_allow_html=True)
-    else:
-        st.warning(f"CSS file '{file_name}' not found.")
+    # Streamlit reruns the whole script per interaction; read the file once per session.
+    css_cache = st.session_state.setdefault("_css_cache", {})
+    if file_name not in css_cache:
+        try:
+            with open(file_name, encoding="utf-8") as file:
+                css_cache[file_name] = file.read()
+        except FileNotFoundError:
+            st.warning(f"CSS file '{file_name}' not found.")
+            return
+    st.markdown(f"<style>{css_cache[file_name]}</style>", unsafe_allow_html=True)
 
 
-def create_chat_id():
+def create_chat_id(now=None):
     """Create a unique chat ID based on timestamp"""
-    return datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    return (now or datetime.now()).strftime("%Y%m%d_%H%M%S_%f")
 
 
 def render_dosha_result(result):
@@ -269,6 +486,9 @@ def render_body_type_assessment(user_id, session_key_dosha_results, session_key_
 def main():
     load_dotenv()
 
+    # Build the RAG pipeline in the background while the page renders.
+    warm_up()
+
     st.set_page_config(
         page_title="VedaBot",
         page_icon="https://res.cloudinary.com/dokavb4tb/image/upload/v1757239450/healthai-favicon_ovvzqj.png",
@@ -293,6 +513,7 @@ def main():
     session_key_selected_chat = f"selected_chat_{user_id}"
     session_key_viewing_history = f"viewing_history_{user_id}"
     session_key_loading = f"loading_{user_id}"
+    session_key_pending_query = f"pending_query_{user_id}"
     session_key_dosha_results = f"dosha_results_{user_id}"
     session_key_show_assessment = f"show_body_type_assessment_{user_id}"
 
@@ -317,6 +538,10 @@ def main():
         st.session_state[session_key_show_assessment] = True
         st.session_state[session_key_viewing_history] = False
 
+    # Time-based flush for entries still buffered from a previous rerun.
+    if st.session_state.get(get_pending_saves_key(user_id)) and time.time() - st.session_state.get(get_last_flush_key(user_id), 0.0) >= PENDING_FLUSH_MAX_AGE_SECONDS:
+        flush_pending_entries(user_id)
+
     st.markdown(
         """
     <style>
@@ -367,6 +592,7 @@ def main():
             st.rerun()
 
         if st.button("New Chat", use_container_width=True, type="primary", disabled=st.session_state[session_key_loading]):
+            flush_pending_entries(user_id)
             st.session_state[session_key_responses] = []
             st.session_state[session_key_current_chat] = None
             st.session_state[session_key_selected_chat] = None
@@ -392,39 +618,58 @@ def main():
         if st.session_state[session_key_chat]:
             st.markdown("<b style='font-size:18px; font-weight:bold;'>Chat History</b>", unsafe_allow_html=True)
 
-            for idx, chat in enumerate(reversed(st.session_state[session_key_chat])):
+            chats = st.session_state[session_key_chat]
+
+            def render_chat_button(actual_idx):
+                chat = chats[actual_idx]
                 chat_preview = chat["question"][:50] + "..." if len(chat["question"]) > 50 else chat["question"]
                 chat_time = chat["time"]
+                is_selected = st.session_state[session_key_selected_chat] == actual_idx
 
-                row_container = st.container()
-                with row_container:
-                    col1 = st.columns([1])[0]
-                    with col1:
-                        is_selected = st.session_state[session_key_selected_chat] == len(st.session_state[session_key_chat]) - 1 - idx
-
-                        if st.button(
-                            f"{chat_preview}",
-                            key=f"chat_{idx}_{chat_time}",
-                            use_container_width=True,
-                            disabled=is_selected or st.session_state[session_key_loading],
-                        ):
-                            actual_idx = len(st.session_state[session_key_chat]) - 1 - idx
-                            selected_chat = st.session_state[session_key_chat][actual_idx]
-
-                            st.session_state[session_key_responses] = []
-                            st.session_state[session_key_responses].append(format_user_query(selected_chat["question"]))
-                            st.session_state[session_key_responses].append(format_bot_response(selected_chat["response"]))
-
-                            st.session_state[session_key_current_chat] = selected_chat.get("chat_id", chat_time)
-                            st.session_state[session_key_selected_chat] = actual_idx
-                            st.session_state[session_key_viewing_history] = True
-                            st.session_state[session_key_show_assessment] = False
-                            st.session_state[session_key_loading] = False
-                            st.rerun()
+                if st.button(
+                    f"{chat_preview}",
+                    key=f"chat_{actual_idx}_{chat_time}",
+                    use_container_width=True,
+                    disabled=is_selected or st.session_state[session_key_loading],
+                ):
+                    selected_chat = chats[actual_idx]
+
+                    st.session_state[session_key_responses] = []
+                    st.session_state[session_key_responses].append(format_user_query(selected_chat["question"]))
+                    st.session_state[session_key_responses].append(format_bot_response(selected_chat["response"]))
+
+                    st.session_state[session_key_current_chat] = selected_chat.get("chat_id", chat_time)
+                    st.session_state[session_key_selected_chat] = actual_idx
+                    st.session_state[session_key_viewing_history] = True
+                    st.session_state[session_key_show_assessment] = False
+                    st.session_state[session_key_loading] = False
+                    st.rerun()
+
+            newest_first = range(len(chats) - 1, -1, -1)
+            for actual_idx in newest_first[:SIDEBAR_RECENT_CHATS]:
+                render_chat_button(actual_idx)
+
+            # Older-chat buttons are only instantiated after an explicit
+            # toggle (an expander body still runs on every rerun), keeping
+            # per-rerun widget count at O(page size).
+            if len(chats) > SIDEBAR_RECENT_CHATS:
+                session_key_show_older = f"show_older_chats_{user_id}"
+                older_count = len(chats) - SIDEBAR_RECENT_CHATS
+                if not st.session_state.get(session_key_show_older):
+                    if st.button(f"Show older chats ({older_count})", use_container_width=True, disabled=st.session_state[session_key_loading]):
+                        st.session_state[session_key_show_older] = True
+                        st.rerun()
+                else:
+                    if st.button("Hide older chats", use_container_width=True, disabled=st.session_state[session_key_loading]):
+                        st.session_state[session_key_show_older] = False
+                        st.rerun()
+                    for actual_idx in newest_first[SIDEBAR_RECENT_CHATS:]:
+                        render_chat_button(actual_idx)
 
             st.markdown("<hr>", unsafe_allow_html=True)
 
             if st.button("Clear All History", use_container_width=True, disabled=st.session_state[session_key_loading]):
+                st.session_state.get(get_pending_saves_key(user_id), []).clear()
                 clear_chat_history(user_id)
                 st.session_state[session_key_chat].clear()
                 st.session_state[session_key_responses].clear()
@@ -472,57 +717,78 @@ def main():
             q = (user_query or "").strip()
             if q:
                 st.session_state[session_key_loading] = True
+                st.session_state[session_key_pending_query] = q
                 st.session_state[session_key_responses].append(format_user_query(q))
                 st.rerun()
 
-        if st.session_state[session_key_loading] and st.session_state[session_key_responses]:
-            last_response = st.session_state[session_key_responses][-1]
-            if "You:" in last_response and "VedaBot:" not in last_response:
-                import re
-
-                query_match = re.search(r"<p>(.*?)</p>", last_response)
-                if query_match:
-                    current_query = query_match.group(1)
-                    dosha_result = st.session_state.get(session_key_dosha_results)
-                    primary_dosha = dosha_result.get("primary_dosha") if dosha_result else None
-
-                    with loader_placeholder, st.spinner("Finding the best Ayurvedic insights..."):
-                        if primary_dosha:
-                            response_data = handle_query(current_query, body_type=primary_dosha)
-                        else:
-                            response_data = handle_query(current_query)
-
-                    loader_placeholder.empty()
-
-                    chat_id = create_chat_id()
-                    chat_entry = {
-                        "chat_id": chat_id,
-                        "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        "question": current_query,
-                    }
-
-                    if response_data:
-                        serializable_response = convert_to_serializable(response_data)
-                        if primary_dosha:
-                            serializable_response["body_type"] = primary_dosha
-                        st.session_state[session_key_responses].append(format_bot_response(response_data, primary_dosha))
-                        chat_entry["response"] = serializable_response
+        if st.session_state[session_key_loading] and st.session_state.get(session_key_pending_query):
+            current_query = st.session_state[session_key_pending_query]
+            dosha_result = st.session_state.get(session_key_dosha_results)
+            primary_dosha = dosha_result.get("primary_dosha") if dosha_result else None
+
+            # Normalize whitespace/case so trivial rephrasings hit the same cache entry.
+            normalized_query = " ".join(current_query.lower().split())
+
+            stream_placeholder = chat_container.empty()
+            streamed_tokens = []
+
+            def render_stream_token(token):
+                # None marks the start of a (re)generation; clear any partial
+                # light-model output before the main model restarts the text.
+                if token is None:
+                    streamed_tokens.clear()
+                    stream_placeholder.empty()
+                    return
+                streamed_tokens.append(token)
+                stream_placeholder.markdown("".join(streamed_tokens) + " ▌")
+
+            with loader_placeholder, st.spinner("Finding the best Ayurvedic insights..."):
+                try:
+                    if primary_dosha:
+                        response_data = cached_handle_query(
+                            normalized_query, body_type=primary_dosha, _on_token=render_stream_token
+                        )
                     else:
-                        error_response = {"result": "No relevant insights found. Please refine your query."}
-                        if primary_dosha:
-                            error_response["body_type"] = primary_dosha
-                        st.session_state[session_key_responses].append(format_bot_response(error_response, primary_dosha))
-                        chat_entry["response"] = error_response
-
-                    st.session_state[session_key_chat].append(chat_entry)
-                    save_chat_history(st.session_state[session_key_chat], user_id)
-
-                    st.session_state[session_key_current_chat] = chat_id
-                    st.session_state[session_key_selected_chat] = len(st.session_state[session_key_chat]) - 1
-                    st.session_state[session_key_viewing_history] = False
-                    st.session_state[session_key_loading] = False
+                        response_data = cached_handle_query(normalized_query, _on_token=render_stream_token)
+                except TransientQueryError as exc:
+                    response_data = exc.response
+
+            loader_placeholder.empty()
+            stream_placeholder.empty()
+
+            # One clock read per entry; the ID and display time derive from it.
+            now = datetime.now()
+            chat_id = create_chat_id(now)
+            chat_entry = {
+                "chat_id": chat_id,
+                "time": now.strftime("%Y-%m-%d %H:%M:%S"),
+                "question": current_query,
+            }
+
+            if response_data:
+                serializable_response = convert_to_serializable(response_data)
+                if primary_dosha:
+                    serializable_response["body_type"] = primary_dosha
+                st.session_state[session_key_responses].append(format_bot_response(response_data, primary_dosha))
+                chat_entry["response"] = serializable_response
+            else:
+                error_response = {"result": "No relevant insights found. Please refine your query."}
+                if primary_dosha:
+                    error_response["body_type"] = primary_dosha
+                st.session_state[session_key_responses].append(format_bot_response(error_response, primary_dosha))
+                chat_entry["response"] = error_response
+
+            st.session_state[session_key_chat].append(chat_entry)
+            queue_chat_entry(chat_entry, user_id)
+            trim_chat_history(st.session_state[session_key_chat], user_id)
+
+            del st.session_state[session_key_pending_query]
+            st.session_state[session_key_current_chat] = chat_id
+            st.session_state[session_key_selected_chat] = len(st.session_state[session_key_chat]) - 1
+            st.session_state[session_key_viewing_history] = False
+            st.session_state[session_key_loading] = False
 
-                    st.rerun()
+            st.rerun()
     else:
         chat_container.markdown(
             """
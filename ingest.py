@@ -1,67 +1,91 @@
-<<<<<<< HEAD
+import os
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_community.document_loaders import PyPDFLoader, DirectoryLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter 
+from langchain.text_splitter import RecursiveCharacterTextSplitter
 
 DATA_PATH = 'data/'
+DB_FAISS_PATH = 'vectorstore/db_faiss'
 
-def create_vector_db():
-    
-    loader = DirectoryLoader(DATA_PATH, glob='*.pdf', loader_cls=PyPDFLoader)
-    
-    documents = loader.load()
+# HNSW graph parameters: roughly 1% recall loss for an order-of-magnitude
+# faster search than the default flat exhaustive scan.
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
 
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=500,chunk_overlap=50)
-    
-    texts = text_splitter.split_documents(documents)
+# IVFPQ parameters for the quantized build (VEDABOT_QUANTIZE_INDEX=1):
+# 48 subquantizers x 8 bits stores 48 bytes per vector instead of the
+# 1536 bytes of FP32, cutting memory traffic ~32x at a small recall cost.
+IVFPQ_NLIST = 256
+IVFPQ_SUBQUANTIZERS = 48
+IVFPQ_BITS = 8
 
-    embeddings = HuggingFaceEmbeddings(
-            model_name='sentence-transformers/all-MiniLM-L6-v2', 
-            model_kwargs={
-                'device': 'cpu'
-                }
-            )
 
-    DB_FAISS_PATH = 'vectorstore/db_faiss'
+def build_index(vectors):
+    """Build an HNSW index, or a trained IVFPQ one when quantization is requested.
 
-    db = FAISS.from_documents(texts, embeddings)
-    
-    db.save_local(DB_FAISS_PATH)
+    Vectors are unit-normalized, so both variants use inner-product scoring:
+    cosine similarity reduces to a single BLAS dot with no per-query
+    normalization work at search time.
+    """
+    dim = vectors.shape[1]
 
-if __name__ == "__main__":
-    create_vector_db()
-=======
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain_community.document_loaders import PyPDFLoader, DirectoryLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter 
+    if os.getenv("VEDABOT_QUANTIZE_INDEX", "").lower() in ("1", "true", "yes"):
+        # faiss wants roughly 39 training points per centroid.
+        nlist = min(IVFPQ_NLIST, max(1, len(vectors) // 39))
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFPQ(
+            quantizer, dim, nlist, IVFPQ_SUBQUANTIZERS, IVFPQ_BITS, faiss.METRIC_INNER_PRODUCT
+        )
+        index.train(vectors)
+        return index
+
+    index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    return index
 
-DATA_PATH = 'data/'
 
 def create_vector_db():
-    
+
     loader = DirectoryLoader(DATA_PATH, glob='*.pdf', loader_cls=PyPDFLoader)
-    
+
     documents = loader.load()
 
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=500,chunk_overlap=50)
-    
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
+
     texts = text_splitter.split_documents(documents)
 
     embeddings = HuggingFaceEmbeddings(
-            model_name='sentence-transformers/all-MiniLM-L6-v2', 
+            model_name='sentence-transformers/all-MiniLM-L6-v2',
             model_kwargs={
                 'device': 'cpu'
+                },
+            encode_kwargs={
+                'normalize_embeddings': True
                 }
             )
 
-    DB_FAISS_PATH = 'vectorstore/db_faiss'
+    contents = [doc.page_content for doc in texts]
+    metadatas = [doc.metadata for doc in texts]
+    vectors = np.asarray(embeddings.embed_documents(contents), dtype='float32')
+    # Belt and braces for vectors from older encoders that ignore the flag.
+    faiss.normalize_L2(vectors)
+
+    db = FAISS(
+        embedding_function=embeddings,
+        index=build_index(vectors),
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={},
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+    )
+    db.add_embeddings(zip(contents, vectors), metadatas=metadatas)
 
-    db = FAISS.from_documents(texts, embeddings)
-    
     db.save_local(DB_FAISS_PATH)
 
+
 if __name__ == "__main__":
     create_vector_db()
->>>>>>> hf/main
@@ -1,32 +1,51 @@
-﻿import logging
+﻿import functools
+import hashlib
+import logging
 import os
+import pickle
 import re
-from typing import List, Optional
-
-from huggingface_hub import InferenceClient
-from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
-
-try:
-    # LangChain <= 0.1.x
-    from langchain.llms.base import LLM
-except ImportError:
-    # LangChain >= 0.2.x / 1.x
-    from langchain_core.language_models.llms import LLM
-
-try:
-    # LangChain <= 0.1.x
-    from langchain.prompts import PromptTemplate
-except ImportError:
-    # LangChain >= 0.2.x
-    from langchain_core.prompts import PromptTemplate
+import threading
+import time
 
 logging.basicConfig(level=logging.ERROR)
+logger = logging.getLogger(__name__)
 
 DB_FAISS_PATH = "vectorstore/db_faiss"
 
-custom_prompt_template = """
-You are an Ayurveda Advisor. Use the following information to answer the user's question in detail.
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+DEFAULT_LLM_MODEL = "meta-llama/Meta-Llama-3-8B-Instruct"
+
+# Cheaper model for low-complexity questions; answers that come back
+# suspiciously short are retried on the main model.
+DEFAULT_LIGHT_LLM_MODEL = "meta-llama/Llama-3.2-3B-Instruct"
+LIGHT_MODEL_MIN_RESULT_CHARS = 80
+SIMPLE_QUERY_MAX_WORDS = 8
+
+MAX_NEW_TOKENS = 512
+LLM_TEMPERATURE = 0.1
+
+# Per-request timeout for the inference endpoint; without one a stalled
+# connection can hang a rerun indefinitely.
+LLM_TIMEOUT_SECONDS = 30
+
+# Output-token budgets by apparent question depth; generation wall-clock is
+# linear in tokens produced, so don't pay for 512 when 128 will do.
+OUTPUT_BUDGET_SIMPLE = 128
+OUTPUT_BUDGET_MEDIUM = 256
+MEDIUM_QUERY_MAX_WORDS = 24
+
+# Breadth of the HNSW search beam when the index was built as HNSW (see
+# ingest.py); higher is more accurate but slower.
+HNSW_EF_SEARCH = 64
+
+# Inverted lists probed per query when the index was built as IVFPQ.
+IVFPQ_NPROBE = 8
+
+# Static instruction block sent as the system message. Keeping it byte-identical
+# across calls (no per-call interpolation) lets providers reuse the cached
+# tokenized prefix; everything volatile goes into the user message below.
+SYSTEM_PROMPT = """You are an Ayurveda Advisor. Use the provided information to answer the user's question in detail.
 - Only answer questions related to Ayurvedic remedies, herbs, diet, lifestyle, wellness routines, symptoms, and Ayurveda education.
 - If a question asks for anything outside Ayurvedic remedies or Ayurveda wellness guidance, refuse clearly and redirect the user to ask an Ayurveda-related health question.
 - Every answer must explicitly mention the user's body type.
@@ -35,13 +54,30 @@ You are an Ayurveda Advisor. Use the following information to answer the user's
 - Do **not** include any reference sections.
 - Always convert follow-up questions into standalone questions while keeping context.
 - Format your response in markdown with **bold**, _italics_, and bullet points where needed.
+- Answer in at most 5 concise bullet points unless the user explicitly asks for depth.
 - If the answer exceeds 120 tokens, structure it into clear points.
-- Personalize general lifestyle, diet, and routine suggestions for the user's dosha without treating it as a medical diagnosis.
+- Personalize general lifestyle, diet, and routine suggestions for the user's dosha without treating it as a medical diagnosis."""
 
-Context: {context}
+custom_prompt_template = """Context: {context}
 User body type: {body_type}
-Question: {question}
-"""
+Question: {question}"""
+
+# Bound once so the hot path calls str.format directly with no template
+# object rebuilt or re-validated per query.
+_PROMPT_FN = custom_prompt_template.format
+
+# Error texts returned in place of a completion when generation fails. Kept
+# as constants so callers (and the caches) can tell them apart from answers.
+AUTH_ERROR_RESPONSE = "Authentication failed with Hugging Face. The access token may be expired or invalid."
+RATE_LIMIT_RESPONSE = "Hugging Face rate limit reached. Please retry after a short wait."
+GENERATION_ERROR_RESPONSE = "Error generating response."
+_GENERATION_ERROR_RESPONSES = (AUTH_ERROR_RESPONSE, RATE_LIMIT_RESPONSE, GENERATION_ERROR_RESPONSE)
+
+
+def is_generation_error(result):
+    """Return True when the result text is a generation failure, not an answer."""
+    return result in _GENERATION_ERROR_RESPONSES
+
 
 OUT_OF_SCOPE_RESPONSE = (
     "I can only help with Ayurvedic remedies, herbs, diet, lifestyle routines, "
@@ -379,6 +415,16 @@ COMMON_HEALTH_TYPOS = {
     "vomitting": "vomiting",
 }
 
+DETAIL_REQUEST_KEYWORDS = {
+    "explain",
+    "detail",
+    "detailed",
+    "elaborate",
+    "compare",
+    "difference",
+    "why",
+}
+
 QUESTION_FILLER_WORDS = {
     "a",
     "about",
@@ -787,6 +833,27 @@ def is_ayurveda_scope_query(question):
     )
 
 
+def predict_output_budget(question):
+    """Pick a max_new_tokens budget from the question's apparent depth."""
+    normalized_question = normalize_question(question)
+    if contains_keyword(normalized_question, DETAIL_REQUEST_KEYWORDS):
+        return MAX_NEW_TOKENS
+    words = len(normalized_question.split())
+    if words <= SIMPLE_QUERY_MAX_WORDS:
+        return OUTPUT_BUDGET_SIMPLE
+    if words <= MEDIUM_QUERY_MAX_WORDS:
+        return OUTPUT_BUDGET_MEDIUM
+    return MAX_NEW_TOKENS
+
+
+def is_simple_question(question):
+    """Short questions with no request for depth can go to the light model."""
+    normalized_question = normalize_question(question)
+    if contains_keyword(normalized_question, DETAIL_REQUEST_KEYWORDS):
+        return False
+    return len(normalized_question.split()) <= SIMPLE_QUERY_MAX_WORDS
+
+
 def get_urgent_safety_response(question):
     normalized_question = normalize_question(question)
     for keywords, response in URGENT_SAFETY_CATEGORIES:
@@ -811,79 +878,358 @@ def ensure_follow_up_questions(result, question, body_type=None):
     return f"{answer_without_followups}\n\n{build_follow_up_questions(question, body_type)}"
 
 
-class HuggingFaceConversationalLLM(LLM):
-    client: InferenceClient
-    max_new_tokens: int = 512
-    temperature: float = 0.1
-
-    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
-        """Send the prompt to HuggingFace for conversational generation."""
-        try:
-            response = self.client.chat_completion(
-                model=self.client.model,
-                messages=[
-                    {"role": "system", "content": "You are a helpful Ayurveda advisor."},
-                    {"role": "user", "content": prompt},
-                ],
-                max_tokens=self.max_new_tokens,
-                temperature=self.temperature,
-            )
-            message = response.choices[0].message
-            if hasattr(message, "content"):
-                return (message.content or "").strip()
-            if isinstance(message, dict):
-                return (message.get("content") or "").strip()
-            return str(message).strip()
-        except Exception as exc:
-            logging.error("Generation failed: %s", exc)
-            error_text = str(exc).lower()
-            if "401" in error_text or "unauthorized" in error_text or "forbidden" in error_text:
-                return "Authentication failed with Hugging Face. The access token may be expired or invalid."
-            if "429" in error_text or "rate limit" in error_text:
-                return "Hugging Face rate limit reached. Please retry after a short wait."
-            return "Error generating response."
-
-    @property
-    def _identifying_params(self):
-        return {"model": self.client.model}
-
-    @property
-    def _llm_type(self):
-        return "huggingface_conversational"
-
-
-def set_custom_prompt():
-    return PromptTemplate(template=custom_prompt_template, input_variables=["context", "body_type", "question"])
+# In-flight request coalescing: when several sessions submit the same prompt
+# concurrently, only the first actually calls the API and the rest wait for
+# its result. (Server-side continuous batching already merges distinct
+# concurrent prompts, so a client-side micro-batch queue buys nothing there.)
+_inflight_lock = threading.Lock()
+_inflight = {}
+
+
+def _coalesce_inflight(key, generate):
+    with _inflight_lock:
+        entry = _inflight.get(key)
+        is_leader = entry is None
+        if is_leader:
+            entry = {"event": threading.Event()}
+            _inflight[key] = entry
+
+    if not is_leader:
+        entry["event"].wait()
+        return entry.get("result", "")
+
+    try:
+        entry["result"] = generate()
+        return entry["result"]
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+        entry["event"].set()
+
+
+def _stream_completion(client, prompt, model=None, max_tokens=MAX_NEW_TOKENS, on_token=None):
+    """Stream the prompt through HuggingFace conversational generation.
+
+    on_token, when given, receives each delta as it arrives so the UI can
+    paint partial output; it is first called with None to mark the start of a
+    fresh completion (a retry on the main model restarts the text).
+    """
+    try:
+        if on_token is not None:
+            on_token(None)
+        pieces = []
+        for chunk in client.chat_completion(
+            model=model or client.model,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt},
+            ],
+            max_tokens=max_tokens,
+            temperature=LLM_TEMPERATURE,
+            stream=True,
+        ):
+            if not chunk.choices:
+                continue
+            token = chunk.choices[0].delta.content or ""
+            if token:
+                pieces.append(token)
+                if on_token is not None:
+                    on_token(token)
+        return "".join(pieces).strip()
+    except Exception as exc:
+        logger.error("Generation failed: %s", exc)
+        error_text = str(exc).lower()
+        if "401" in error_text or "unauthorized" in error_text or "forbidden" in error_text:
+            return AUTH_ERROR_RESPONSE
+        if "429" in error_text or "rate limit" in error_text:
+            return RATE_LIMIT_RESPONSE
+        return GENERATION_ERROR_RESPONSE
+
+
+def generate_answer(client, prompt, model=None, max_tokens=MAX_NEW_TOKENS, on_token=None):
+    """Generate a completion, sharing in-flight duplicates across callers.
+
+    Only the leader of a coalesced group streams tokens; followers get the
+    finished result when it lands.
+    """
+    target_model = model or client.model
+    result = _coalesce_inflight(
+        (target_model, max_tokens, prompt),
+        lambda: _stream_completion(client, prompt, target_model, max_tokens, on_token),
+    )
+    if target_model != client.model and len(result) < LIGHT_MODEL_MIN_RESULT_CHARS:
+        # The light model punted; escalate to the main model.
+        result = _coalesce_inflight(
+            (client.model, max_tokens, prompt),
+            lambda: _stream_completion(client, prompt, client.model, max_tokens, on_token),
+        )
+    return result
 
 
 def load_llm():
-    """Load the Hugging Face Inference Client."""
+    """Load the Hugging Face Inference Client.
+
+    The client rides on huggingface_hub's process-wide pooled session, so the
+    singleton in _get_chain means every call reuses one keep-alive TLS
+    connection instead of paying handshake + slow-start per request.
+    """
+    from huggingface_hub import InferenceClient
+
     api_token = os.getenv("HUGGINGFACEHUB_ACCESS_TOKEN")
     if not api_token:
         raise ValueError("HUGGINGFACEHUB_ACCESS_TOKEN is not set. Add it to your environment variables.")
 
     try:
-        client = InferenceClient(model="meta-llama/Meta-Llama-3-8B-Instruct", token=api_token)
-        print("LLaMA 3 model loaded successfully.")
-        return HuggingFaceConversationalLLM(client=client)
+        client = InferenceClient(
+            model=os.getenv("VEDABOT_LLM_MODEL", DEFAULT_LLM_MODEL),
+            token=api_token,
+            timeout=LLM_TIMEOUT_SECONDS,
+        )
+        logger.info("Inference client initialized for %s", client.model)
+        return client
     except Exception as exc:
-        logging.error("Failed to load model: %s", exc)
+        logger.error("Failed to load model: %s", exc)
         raise RuntimeError("Model loading failed. Check your token or network.")
 
 
-def create_chat_bot_chain():
-    embeddings = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-MiniLM-L6-v2",
+# Int8-quantized ONNX export shipped in the MiniLM model repo; quantization
+# roughly halves encode latency again on top of the fp32 ONNX gain.
+ONNX_QUANTIZED_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
+
+def _load_embeddings():
+    """Load the MiniLM embedder, optionally via an int8-quantized ONNX backend.
+
+    Set VEDABOT_EMBEDDINGS_BACKEND=onnx to run the encoder through
+    sentence-transformers' ONNX Runtime backend, preferring the int8-quantized
+    export and falling back to the fp32 ONNX model, then to torch, when the
+    quantized weights or the ONNX extras are unavailable.
+    """
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    if os.getenv("VEDABOT_EMBEDDINGS_BACKEND", "").lower() == "onnx":
+        for model_kwargs in (
+            # The nested model_kwargs dict is forwarded to the ONNX loader.
+            {"device": "cpu", "backend": "onnx", "model_kwargs": {"file_name": ONNX_QUANTIZED_FILE}},
+            {"device": "cpu", "backend": "onnx"},
+        ):
+            try:
+                return HuggingFaceEmbeddings(
+                    model_name=EMBEDDING_MODEL,
+                    model_kwargs=model_kwargs,
+                )
+            except Exception as exc:
+                logger.error("ONNX embedding backend unavailable, trying fallback: %s", exc)
+    return HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL,
         model_kwargs={"device": "cpu"},
     )
-    db = FAISS.load_local(DB_FAISS_PATH, embeddings, allow_dangerous_deserialization=True)
-    llm = load_llm()
-    qa_prompt = set_custom_prompt()
-    return db, llm, qa_prompt
 
 
-def handle_query(question, body_type=None):
-    """Handle user queries."""
+def _distance_strategy_for(index):
+    """Pick the scoring strategy matching how the index was built.
+
+    New indexes from ingest.py are inner-product over unit-norm vectors;
+    stores built before that change are still L2 and keep working unchanged.
+    """
+    import faiss
+    from langchain_community.vectorstores.utils import DistanceStrategy
+
+    if getattr(index, "metric_type", None) == faiss.METRIC_INNER_PRODUCT:
+        return DistanceStrategy.MAX_INNER_PRODUCT
+    return DistanceStrategy.EUCLIDEAN_DISTANCE
+
+
+def _load_vectorstore(embeddings):
+    """Load the FAISS store, memory-mapping the index file when possible.
+
+    FAISS.load_local materializes the entire index in RAM up front; with
+    IO_FLAG_MMAP the OS pages in only the vectors each query touches, so
+    cold start shrinks to an open() and resident memory to the working set.
+    Index types faiss cannot mmap fall back to the regular loader.
+    """
+    import faiss
+    from langchain_community.vectorstores import FAISS
+
+    try:
+        index = faiss.read_index(
+            os.path.join(DB_FAISS_PATH, "index.faiss"),
+            faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY,
+        )
+        with open(os.path.join(DB_FAISS_PATH, "index.pkl"), "rb") as file:
+            docstore, index_to_docstore_id = pickle.load(file)
+        return FAISS(
+            embedding_function=embeddings,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id,
+            distance_strategy=_distance_strategy_for(index),
+        )
+    except Exception as exc:
+        logger.error("Memory-mapped index load failed, using full load: %s", exc)
+        db = FAISS.load_local(DB_FAISS_PATH, embeddings, allow_dangerous_deserialization=True)
+        db.distance_strategy = _distance_strategy_for(db.index)
+        return db
+
+
+def create_chat_bot_chain():
+    import faiss
+
+    embeddings = _load_embeddings()
+    db = _load_vectorstore(embeddings)
+    if getattr(db.index, "metric_type", None) == faiss.METRIC_INNER_PRODUCT:
+        # Inner-product indexes from ingest.py store unit-norm vectors, so
+        # queries must be unit-norm too. Legacy L2 stores hold unnormalized
+        # vectors; normalizing queries against them would shift the ranking,
+        # so the flag is only enabled to match the index actually loaded.
+        embeddings.encode_kwargs["normalize_embeddings"] = True
+    if hasattr(db.index, "hnsw"):
+        db.index.hnsw.efSearch = HNSW_EF_SEARCH
+    if hasattr(db.index, "nprobe"):
+        db.index.nprobe = IVFPQ_NPROBE
+    client = load_llm()
+    return db, client
+
+
+_chain_lock = threading.Lock()
+_chain = None
+
+
+def _get_chain():
+    """Build the FAISS index, embeddings, and LLM client once and reuse them.
+
+    Rebuilding the pipeline per query re-read the index and re-initialized the
+    embedding model each time, costing hundreds of ms before retrieval began.
+    """
+    global _chain
+    if _chain is None:
+        with _chain_lock:
+            if _chain is None:
+                _chain = create_chat_bot_chain()
+    return _chain
+
+
+# Semantic response cache: reuse a generated answer when a new question's
+# embedding is close enough to one already answered for the same body type.
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_MAX_ENTRIES = 256
+SEMANTIC_CACHE_TTL_SECONDS = 3600
+
+_semantic_cache_lock = threading.Lock()
+_semantic_cache = []  # entries: (unit-norm float32 vector, body_type, result, stored_at)
+
+
+def _normalize_vector(query_vector):
+    """Return the vector as a unit-norm float32 array, or None if degenerate."""
+    import numpy as np
+
+    vector = np.asarray(query_vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm == 0.0:
+        return None
+    return vector / norm
+
+
+def _semantic_cache_lookup(query_vector, body_type):
+    """Return the best cached answer above the similarity threshold, if any."""
+    query = _normalize_vector(query_vector)
+    if query is None:
+        return None
+    best_result = None
+    best_similarity = SEMANTIC_CACHE_THRESHOLD
+    now = time.time()
+    with _semantic_cache_lock:
+        # Age out stale entries before scanning; doshas don't change hourly,
+        # but the source index and prompts do get redeployed.
+        _semantic_cache[:] = [
+            entry for entry in _semantic_cache if now - entry[3] < SEMANTIC_CACHE_TTL_SECONDS
+        ]
+        for vector, cached_body_type, result, _stored_at in _semantic_cache:
+            if cached_body_type != body_type:
+                continue
+            # Entries are pre-normalized, so cosine is a single BLAS dot.
+            similarity = float(vector @ query)
+            if similarity >= best_similarity:
+                best_result = result
+                best_similarity = similarity
+    return best_result
+
+
+def _semantic_cache_store(query_vector, body_type, result):
+    vector = _normalize_vector(query_vector)
+    if vector is None:
+        return
+    with _semantic_cache_lock:
+        _semantic_cache.append((vector, body_type, result, time.time()))
+        if len(_semantic_cache) > SEMANTIC_CACHE_MAX_ENTRIES:
+            del _semantic_cache[0]
+
+
+@functools.lru_cache(maxsize=1024)
+def _embed_query_cached(question):
+    """Embed a case/whitespace-normalized question, caching repeats.
+
+    FAQ-style traffic re-asks the same questions often; a hit skips the whole
+    MiniLM forward pass. Tuples keep the cached vectors hashable and immutable.
+    """
+    db, _ = _get_chain()
+    return tuple(db.embeddings.embed_query(question))
+
+
+_warm_up_lock = threading.Lock()
+_warm_up_started = False
+
+
+def _warm_up_target():
+    try:
+        _get_chain()
+    except Exception as exc:
+        logger.error("Pipeline warm-up failed: %s", exc)
+
+
+def warm_up():
+    """Start building the pipeline on a background thread.
+
+    Lets index loading and model init overlap the first page render instead of
+    stalling the first question; _get_chain's lock keeps this race-free.
+    """
+    global _warm_up_started
+    with _warm_up_lock:
+        if _warm_up_started:
+            return
+        _warm_up_started = True
+    threading.Thread(target=_warm_up_target, name="vedabot-warmup", daemon=True).start()
+
+
+# Unique chunks stuffed into the prompt, and how many candidates to pull so
+# duplicates (overlapping PDF splits indexed more than once) can be dropped
+# without coming up short.
+RETRIEVAL_K = 2
+RETRIEVAL_FETCH_K = 4
+
+
+def _retrieve_unique_documents(db, query_vector, k=RETRIEVAL_K, fetch_k=RETRIEVAL_FETCH_K):
+    """Return the top-k retrieved documents with exact duplicates removed.
+
+    Duplicate chunks add input tokens without adding information; a content
+    hash drops them before the prompt is built.
+    """
+    docs = db.similarity_search_by_vector(query_vector, k=fetch_k)
+    seen = set()
+    unique_docs = []
+    for doc in docs:
+        digest = hashlib.blake2b(doc.page_content.encode("utf-8"), digest_size=16).digest()
+        if digest in seen:
+            continue
+        seen.add(digest)
+        unique_docs.append(doc)
+        if len(unique_docs) == k:
+            break
+    return unique_docs
+
+
+def handle_query(question, body_type=None, on_token=None):
+    """Handle user queries, forwarding streamed tokens to on_token when given."""
     try:
         urgent_safety_response = get_urgent_safety_response(question)
         if urgent_safety_response:
@@ -897,16 +1243,34 @@ def handle_query(question, body_type=None):
         if not is_ayurveda_scope_query(question):
             return {"result": format_scoped_response(OUT_OF_SCOPE_RESPONSE, body_type), "body_type": body_type}
 
-        db, llm, qa_prompt = create_chat_bot_chain()
-        docs = db.similarity_search(question, k=2)
+        db, client = _get_chain()
+        query_vector = list(_embed_query_cached(" ".join(question.lower().split())))
+
+        cached_result = _semantic_cache_lookup(query_vector, body_type)
+        if cached_result is not None:
+            return {"result": cached_result, "body_type": body_type}
+
+        docs = _retrieve_unique_documents(db, query_vector)
         context = "\n\n".join(doc.page_content for doc in docs)
-        prompt = qa_prompt.format(context=context, body_type=body_type or "Not provided", question=question)
-        result = llm.invoke(prompt)
+        prompt = _PROMPT_FN(context=context, body_type=body_type or "Not provided", question=question)
+        light_model = os.getenv("VEDABOT_LLM_LIGHT_MODEL", DEFAULT_LIGHT_LLM_MODEL)
+        result = generate_answer(
+            client,
+            prompt,
+            model=light_model if is_simple_question(question) else None,
+            max_tokens=predict_output_budget(question),
+            on_token=on_token,
+        )
+        if is_generation_error(result):
+            # Return the error as-is: no follow-up dressing, and never cached,
+            # or one 429 would be replayed for every similar question.
+            return {"result": result, "body_type": body_type}
         result = ensure_follow_up_questions(result, question, body_type)
         result = format_scoped_response(result, body_type)
+        _semantic_cache_store(query_vector, body_type, result)
         return {"result": result, "source_documents": docs, "body_type": body_type}
     except Exception as exc:
-        logging.error("Error processing query: %s", exc)
+        logger.error("Error processing query: %s", exc)
         error_text = str(exc).lower()
         if "huggingfacehub_access_token" in error_text:
             return {